@@ -1,9 +1,30 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import logging
+from contextlib import asynccontextmanager, suppress
+
+from anyio import CapacityLimiter, to_thread
+from argon2 import PasswordHasher
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import sqlite3
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import orjson
+from pydantic import BaseModel, ConfigDict
 import os
 from dotenv import load_dotenv
+import aiosqlite
+from aiosqlitepool import SQLiteConnectionPool
 import fingerprint_pro_server_api_sdk
+from fingerprint_pro_server_api_sdk.rest import ApiException
+
+logger = logging.getLogger(__name__)
+
+# Fingerprint API statuses worth passing through to the client; anything else
+# surfaces as a generic 500
+API_ERROR_DETAILS = {
+    400: "Invalid requestId",
+    404: "Request not found or expired",
+}
 
 # Load environment variables from .env file
 load_dotenv()
@@ -13,29 +34,155 @@ api_key = os.getenv("FINGERPRINT_API_KEY")
 if not api_key:
     raise ValueError("FINGERPRINT_API_KEY environment variable is required")
 
-# Initialize Fingerprint client
+# Initialize Fingerprint client; a larger urllib3 pool keeps TLS sessions to
+# the Fingerprint API warm across concurrent requests instead of
+# re-handshaking per call
 configuration = fingerprint_pro_server_api_sdk.Configuration(api_key=api_key, region="eu")
+configuration.connection_pool_maxsize = 64
 client = fingerprint_pro_server_api_sdk.FingerprintApi(configuration)
 
+# Password hasher with argon2's default memory/time parameters
+password_hasher = PasswordHasher()
+
+# Separate thread capacity for outbound Fingerprint calls and CPU-bound
+# hashing, so a slow Fingerprint API can't starve hashing (or vice versa)
+fingerprint_limiter = CapacityLimiter(64)
+hashing_limiter = CapacityLimiter(os.cpu_count() or 1)
+
+# Cache events briefly so client retries of the same requestId (double-click,
+# reconnect) don't pay another round trip to the Fingerprint API
+event_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+inflight_events: dict = {}
+
+async def fetch_event(request_id):
+    if request_id in event_cache:
+        return event_cache[request_id]
+
+    # Coalesce concurrent lookups for the same requestId into one API call
+    task = inflight_events.get(request_id)
+    if task is None:
+        task = asyncio.create_task(
+            to_thread.run_sync(client.get_event, request_id, limiter=fingerprint_limiter)
+        )
+        inflight_events[request_id] = task
+        task.add_done_callback(lambda _: inflight_events.pop(request_id, None))
+
+    event = await task
+    event_cache[request_id] = event
+    return event
+
 # Initialize SQLite database
-def init_database():
-    conn = sqlite3.connect("database.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS accounts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT,
-            password TEXT,
-            visitorId TEXT
+async def init_database(pool):
+    async with pool.connection() as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS accounts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT,
+                password TEXT,
+                visitorId TEXT
+            )
+        """)
+        # Unique index turns the one-account-per-device check into an index probe
+        await conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_accounts_visitor ON accounts(visitorId)"
         )
+        await conn.commit()
+
+INSERT_ACCOUNT_SQL = (
+    "INSERT INTO accounts (username, password, visitorId) VALUES (?, ?, ?) "
+    "ON CONFLICT(visitorId) DO NOTHING"
+)
+
+async def db_connection():
+    # Autocommit mode with explicit BEGIN/COMMIT where needed; a larger
+    # statement cache keeps the hot queries compiled between requests
+    conn = await aiosqlite.connect("database.db", isolation_level=None, cached_statements=256)
+    # WAL lets /api/accounts read while create_account commits, and
+    # synchronous=NORMAL drops the per-commit fsync; the rest trims read syscalls
+    await conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-20000;
     """)
-    conn.commit()
-    conn.close()
+    return conn
+
+async def account_writer(app):
+    # Single writer task: drain whatever inserts are queued and commit them in
+    # one transaction, so a burst of signups shares one WAL commit/fsync
+    # instead of paying one each
+    queue = app.state.write_queue
+    conn = app.state.writer_conn
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < 100 and not queue.empty():
+            batch.append(queue.get_nowait())
 
-# Initialize database on startup
-init_database()
+        # Any failure (including BEGIN itself timing out on the WAL write
+        # lock) must resolve every queued future and leave the loop running,
+        # or all later signups would hang on their awaits
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            rowcounts = []
+            for _, params in batch:
+                cursor = await conn.execute(INSERT_ACCOUNT_SQL, params)
+                rowcounts.append(cursor.rowcount)
+            await conn.execute("COMMIT")
+        except Exception as error:
+            # ROLLBACK itself can raise ("no transaction is active") after
+            # some COMMIT failures; the original error is the one that matters
+            with suppress(Exception):
+                await conn.execute("ROLLBACK")
+            for future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for (future, _), rowcount in zip(batch, rowcounts):
+                if not future.done():
+                    future.set_result(rowcount)
 
-app = FastAPI(title="Fingerprint Python Backend", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Raise the default threadpool cap (40) for work that isn't covered by a
+    # dedicated limiter
+    to_thread.current_default_thread_limiter().total_tokens = 200
+    # Open a connection pool once per process so requests reuse warm
+    # connections instead of paying a connect/close per call
+    app.state.db_pool = SQLiteConnectionPool(db_connection)
+    await init_database(app.state.db_pool)
+    # All inserts go through one writer connection and queue so bursts of
+    # signups are committed together
+    app.state.writer_conn = await db_connection()
+    app.state.write_queue = asyncio.Queue()
+    writer_task = asyncio.create_task(account_writer(app))
+    yield
+    writer_task.cancel()
+    try:
+        await writer_task
+    except asyncio.CancelledError:
+        pass
+    await app.state.writer_conn.close()
+    await app.state.db_pool.close()
+
+app = FastAPI(
+    title="Fingerprint Python Backend",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+class CreateAccountRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    requestId: str
+    username: str
+    password: str
+
+class CreateAccountResponse(BaseModel):
+    status: str
+    visitorId: str
+    botResult: str
 
 # Add CORS middleware for local development
 app.add_middleware(
@@ -46,55 +193,99 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/api/create-account")
-async def create_account(request: dict):
-    # Get visitor identification details using the requestId
-    event = client.get_event(request["requestId"])
-    
-    # Convert event to dictionary for easier access
-    event_dict = event.to_dict() if hasattr(event, 'to_dict') else event.__dict__
-
-    # Extract visitor ID
-    visitor_id = event_dict["products"]["identification"]["data"]["visitor_id"]
-    
-    # Check for bot activity
-    bot_result = "unknown"
-    if "botd" in event_dict["products"] and event_dict["products"]["botd"]["data"]["bot"]["result"] == "detected":
+@app.post("/api/create-account", responses={200: {"model": CreateAccountResponse}})
+async def create_account(request: CreateAccountRequest):
+    # Get visitor identification details using the requestId (cached for
+    # retries; the underlying SDK call runs on a thread off the event loop)
+    try:
+        event = await fetch_event(request.requestId)
+    except ApiException as error:
+        raise HTTPException(
+            status_code=error.status if error.status in API_ERROR_DETAILS else 500,
+            detail=API_ERROR_DETAILS.get(error.status, "Failed to verify visitor identity"),
+        )
+    # Keep per-request diagnostics level-gated; serializing the full event to
+    # stdout on every call is expensive
+    logger.debug("fingerprint event received rid=%s", request.requestId)
+
+    # Check for bot activity first so flagged traffic exits before we do any
+    # hashing or database work
+    botd = getattr(event.products, "botd", None)
+    bot_result = botd.data.bot.result if botd else "unknown"
+    if bot_result == "detected":
         raise HTTPException(status_code=403, detail="Bot detected")
 
-    # Check if this device has already created an account
-    conn = sqlite3.connect("database.db")
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT COUNT(*) as count FROM accounts WHERE visitorId = ?",
-        (visitor_id,)
+    # Read the fields straight off the SDK model instead of materializing the
+    # whole event as a nested dict
+    visitor_id = event.products.identification.data.visitor_id
+
+    # Hash the password before storing it; argon2 burns tens of ms of CPU by
+    # design, so run it on a thread to keep the event loop free
+    hashed_password = await to_thread.run_sync(
+        password_hasher.hash, request.password, limiter=hashing_limiter
     )
-    row = cursor.fetchone()
-    
-    if row[0] > 0:
-        conn.close()
-        raise HTTPException(status_code=429, detail="Device already has an account")
 
-    # Insert the new account
-    cursor.execute(
-        "INSERT INTO accounts (username, password, visitorId) VALUES (?, ?, ?)",
-        (request["username"], request["password"], visitor_id)
+    # Queue the insert for the single writer task; the unique index on
+    # visitorId rejects the row atomically if this device already has one
+    future = asyncio.get_running_loop().create_future()
+    await app.state.write_queue.put(
+        (future, (request.username, hashed_password, visitor_id))
     )
-    conn.commit()
-    conn.close()
+    if await future == 0:
+        raise HTTPException(status_code=429, detail="Device already has an account")
 
-    return {
+    # Serialize the three-field success body directly; re-validating it
+    # through the response model on the way out buys nothing
+    return ORJSONResponse({
         "status": "Account created successfully!",
         "visitorId": visitor_id,
-        "botResult": bot_result
-    }
+        "botResult": bot_result,
+    })
 
 
+@app.get("/api/accounts")
+async def get_accounts(request: Request, after_id: int = 0, limit: int = Query(100, le=1000)):
+    # Conditional GET: the table is insert-only with monotonic ids, so MAX(id)
+    # is a validator every worker process agrees on, read with a single index
+    # probe. Polling clients that resend it get a header-only 304
+    async with app.state.db_pool.connection() as conn:
+        cursor = await conn.execute("SELECT COALESCE(MAX(id), 0) FROM accounts")
+        row = await cursor.fetchone()
+    etag = f'W/"v{row[0]}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # List created accounts (passwords excluded), streamed as NDJSON so memory
+    # stays bounded no matter how large the table grows. Keyset pagination:
+    # pass the id of the last row you received as after_id for the next page
+    async def iter_rows():
+        async with app.state.db_pool.connection() as conn:
+            async with conn.execute(
+                "SELECT id, username, visitorId FROM accounts WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit),
+            ) as cursor:
+                async for row in cursor:
+                    yield orjson.dumps(
+                        {"id": row[0], "username": row[1], "visitorId": row[2]}
+                    ) + b"\n"
+
+    return StreamingResponse(
+        iter_rows(), media_type="application/x-ndjson", headers={"ETag": etag}
+    )
+
 
 if __name__ == "__main__":
     import uvicorn
     print("Server starting on http://localhost:3001")
     print("Create account: POST http://localhost:3001/api/create-account")
 
-    uvicorn.run(app, host="0.0.0.0", port=3001) 
\ No newline at end of file
+    # uvloop + httptools speed up the event loop and HTTP parsing; multiple
+    # workers give real parallelism (each builds its own DB pool in lifespan)
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=3001,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )